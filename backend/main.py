@@ -1,48 +1,116 @@
-from fastapi import FastAPI, HTTPException, Request, Header
+from fastapi import FastAPI, HTTPException, Request, Header, Response, Body
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
-from typing import List, Dict, Any, Optional, Union
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field, PrivateAttr, model_serializer, model_validator
+from typing import List, Dict, Any, Optional, Union, Tuple, Callable, Iterator, AsyncIterator, Iterable, Awaitable, FrozenSet, Literal, Annotated
 import json
+import orjson
 import ipaddress
 import jwt
 import time
-from datetime import datetime, timedelta
 import re
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import atexit
+import functools
+import asyncio
+import contextlib
+import inspect
+import hashlib
+import bisect
+import itertools
+import math
+from collections import deque, OrderedDict
 import os
+import redis.asyncio as redis
+from cryptography.hazmat.primitives.asymmetric import rsa, ec, ed25519, ed448
+from cryptography.hazmat.primitives.serialization import load_pem_public_key
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+# Records are formatted by the QueueHandler and written by a background thread,
+# so stream I/O never blocks the event loop
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, logging.StreamHandler())
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Run the idle rate limit sweeper for as long as the app is serving"""
+    # Keep a reference on app.state so the task is not garbage collected
+    app.state.rate_limit_sweeper = asyncio.create_task(sweep_rate_limits())
+    try:
+        yield
+    finally:
+        app.state.rate_limit_sweeper.cancel()
+
 app = FastAPI(
     title="ZeroPass Firewall Simulator API",
     description="Enterprise API Gateway Firewall Rule Simulator",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
-# Get allowed origins from environment variable or use default
-# Include Vercel deployment domains and render domains
-allowed_origins = os.getenv("CORS_ORIGINS", "http://localhost:3000,http://localhost:3001,https://*.vercel.app,https://*.zeropass.dev,https://zeropass-firewall-simulator.vercel.app").split(",")
-logger.info(f"CORS allowed origins: {allowed_origins}")
-
-# CORS middleware
+# CORS middleware (a plain ASGI middleware: preflights are answered before routing)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # Allow all origins for easy deployment
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    max_age=7200,  # Let browsers reuse preflight results for 2 hours (Chromium's cap)
 )
 
 # In-memory storage (replace with Redis in production)
 rule_sets: Dict[str, Any] = {}
-rate_limit_store: Dict[str, Dict[str, Any]] = {}
-evaluation_logs: List[Dict[str, Any]] = []
+# Validated rule set models, so simulations skip re-validation: {rule_set_id: FirewallRuleSet}
+rule_set_models: Dict[str, "FirewallRuleSet"] = {}
+# Rule set IDs owned by each user, in creation order: {user_id: {rule_set_id: None}}
+user_rule_index: Dict[str, Dict[str, None]] = {}
+# Precompiled CIDR lookup per rule set: {rule_set_id: CIDRIndex}
+cidr_indexes: Dict[str, "CIDRIndex"] = {}
+# All regex path rules of a rule set combined into one pattern, if possible: {rule_set_id: Pattern}
+combined_path_regexes: Dict[str, Optional[re.Pattern]] = {}
+rate_limit_store: Dict[str, "TokenBucket"] = {}
+
+# Optional Redis for rate limiting. Only token buckets live there; rule sets,
+# logs and scenario results stay in process memory, which is why deployments
+# run a single uvicorn worker.
+REDIS_URL = os.getenv("REDIS_URL")
+# Short timeouts so an unreachable Redis falls back quickly instead of stalling requests
+REDIS_TIMEOUT_SECONDS = float(os.getenv("REDIS_TIMEOUT_SECONDS", "0.25"))
+redis_client = redis.Redis.from_url(
+    REDIS_URL,
+    socket_connect_timeout=REDIS_TIMEOUT_SECONDS,
+    socket_timeout=REDIS_TIMEOUT_SECONDS
+) if REDIS_URL else None
+# After a Redis failure, use the in-memory store for this long before retrying
+REDIS_RETRY_SECONDS = float(os.getenv("REDIS_RETRY_SECONDS", "30"))
+redis_retry_at = 0.0
+# Per-user ring buffers of recent evaluations as (epoch timestamp, orjson-encoded
+# entry) tuples; the oldest entries drop off once a user's buffer is full
+MAX_EVALUATION_LOGS_PER_USER = int(os.getenv("MAX_EVALUATION_LOGS_PER_USER", "10000"))
+evaluation_logs: Dict[str, deque] = {}
+# Upper bound on requests accepted by a single /simulate/batch call, enforced
+# while the body is validated so oversized batches are rejected with a 422
+MAX_BATCH_SIMULATIONS = 1000
+
+def format_timestamp(timestamp: float) -> str:
+    """Format an epoch timestamp as an ISO-8601 UTC string"""
+    fraction, seconds = math.modf(timestamp)
+    microseconds = round(fraction * 1_000_000)
+    if microseconds >= 1_000_000:
+        seconds += 1
+        microseconds -= 1_000_000
+    return f"{time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds))}.{microseconds:06d}Z"
 
 # User isolation utility functions
 def get_user_id(x_user_id: Optional[str] = None) -> str:
@@ -52,18 +120,41 @@ def get_user_id(x_user_id: Optional[str] = None) -> str:
     # Fallback for requests without user ID (legacy)
     return "anonymous_user"
 
-def filter_by_user(items: List[Dict[str, Any]], user_id: str) -> List[Dict[str, Any]]:
-    """Filter items to only return those belonging to the specified user"""
-    return [item for item in items if item.get('userId') == user_id]
+@functools.lru_cache(maxsize=1024)
+def compile_pattern(pattern: str) -> re.Pattern:
+    """Compile a rule regex once and reuse it across simulations"""
+    return re.compile(pattern)
 
-def add_user_id_to_item(item: Dict[str, Any], user_id: str) -> Dict[str, Any]:
-    """Add user ID to an item"""
-    item['userId'] = user_id
-    return item
+def compile_regex(pattern: str) -> re.Pattern:
+    """Compile a rule regex, raising ValueError so model validation rejects bad patterns"""
+    try:
+        return compile_pattern(pattern)
+    except re.error as e:
+        raise ValueError(f"Invalid regex pattern: {pattern} ({e})")
+
+@functools.lru_cache(maxsize=64)
+def load_jwt_key(key: str) -> Any:
+    """Parse a PEM public key once; anything else is used as a shared secret"""
+    if key.lstrip().startswith("-----BEGIN"):
+        try:
+            return load_pem_public_key(key.encode())
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"Invalid PEM public key ({e})")
+    return key
+
+# Key types each JWT algorithm family verifies with: shared secrets for HMAC,
+# public keys of the matching type for everything else
+JWT_ALGORITHM_KEY_TYPES: Dict[str, Tuple[type, ...]] = {
+    "HS": (str,),
+    "RS": (rsa.RSAPublicKey,),
+    "PS": (rsa.RSAPublicKey,),
+    "ES": (ec.EllipticCurvePublicKey,),
+    "EdDSA": (ed25519.Ed25519PublicKey, ed448.Ed448PublicKey),
+}
 
 # Models
 class IPRule(BaseModel):
-    type: str = Field(..., pattern="^(allow|block)$")
+    type: Literal["allow", "block"]
     cidrs: List[str]
 
 class JWTRule(BaseModel):
@@ -71,10 +162,45 @@ class JWTRule(BaseModel):
     required_claims: Optional[Dict[str, Any]] = None
     issuer: Optional[str] = None
     audience: Optional[str] = None
+    verification_key: Optional[str] = None  # PEM public key or HMAC shared secret; enables signature checks
+    algorithms: Optional[List[str]] = None  # Only used with verification_key; defaults to RS256 for PEM keys, HS256 for secrets
+
+    @model_validator(mode="after")
+    def check_key_algorithms(self) -> "JWTRule":
+        # Reject keys that cannot verify the configured algorithms when the rule
+        # set is created, instead of failing on every simulation
+        if not self.verification_key:
+            return self
+        key = load_jwt_key(self.verification_key)
+        if self.algorithms is None:
+            self.algorithms = ["HS256"] if isinstance(key, str) else ["RS256"]
+        if not self.algorithms:
+            raise ValueError("At least one JWT algorithm is required")
+        for algorithm in self.algorithms:
+            family = algorithm if algorithm == "EdDSA" else algorithm[:2]
+            key_types = JWT_ALGORITHM_KEY_TYPES.get(family)
+            if key_types is None or algorithm not in jwt.algorithms.get_default_algorithms():
+                raise ValueError(f"Unsupported JWT algorithm: {algorithm}")
+            if not isinstance(key, key_types):
+                raise ValueError(f"JWT algorithm {algorithm} cannot be used with the configured key")
+        return self
+
+    @model_serializer(mode="wrap")
+    def omit_unused_algorithms(self, handler):
+        # Algorithms mean nothing without a verification key, so keep them out of stored rule sets
+        data = handler(self)
+        if not self.verification_key:
+            data.pop("algorithms", None)
+        return data
 
 class OAuth2Rule(BaseModel):
     enabled: bool = True
     required_scopes: List[str] = []
+    _required: FrozenSet[str] = PrivateAttr(default=frozenset())
+
+    def model_post_init(self, __context: Any) -> None:
+        # Build the scope set once so each simulation only computes a difference
+        self._required = frozenset(self.required_scopes)
 
 class RateLimitRule(BaseModel):
     enabled: bool = True
@@ -83,13 +209,34 @@ class RateLimitRule(BaseModel):
     
 class HeaderRule(BaseModel):
     header_name: str
-    condition: str = Field(..., pattern="^(equals|contains|regex|exists)$")
+    condition: Literal["equals", "contains", "regex", "exists"]
     value: Optional[str] = None
+    _compiled: Optional[re.Pattern] = PrivateAttr(default=None)
+
+    @model_validator(mode="after")
+    def precompile_regex(self) -> "HeaderRule":
+        # Compile once when the rule set is created, not per simulation
+        if self.condition == "regex" and self.value:
+            self._compiled = compile_regex(self.value)
+        return self
 
 class PathRule(BaseModel):
     methods: List[str] = []
     path_pattern: str
-    condition: str = Field(..., pattern="^(equals|prefix|regex)$")
+    condition: Literal["equals", "prefix", "regex"]
+    _allowed_methods: FrozenSet[str] = PrivateAttr(default=frozenset())
+    _compiled: Optional[re.Pattern] = PrivateAttr(default=None)
+
+    def model_post_init(self, __context: Any) -> None:
+        # Uppercase once so each simulation does a single set lookup
+        self._allowed_methods = frozenset(m.upper() for m in self.methods)
+
+    @model_validator(mode="after")
+    def precompile_regex(self) -> "PathRule":
+        # Compile once when the rule set is created, not per simulation
+        if self.condition == "regex":
+            self._compiled = compile_regex(self.path_pattern)
+        return self
 
 class FirewallRuleSet(BaseModel):
     id: str
@@ -101,7 +248,7 @@ class FirewallRuleSet(BaseModel):
     rate_limiting: Optional[RateLimitRule] = None
     header_rules: List[HeaderRule] = []
     path_rules: List[PathRule] = []
-    default_action: str = Field(..., pattern="^(allow|block)$")
+    default_action: Literal["allow", "block"]
     userId: Optional[str] = None  # Added for user isolation
 
 # Rule Templates Models
@@ -162,31 +309,187 @@ class SimulationResult(BaseModel):
 # Storage for templates and scenarios
 rule_templates: Dict[str, RuleTemplate] = {}
 exploit_scenarios: Dict[str, ExploitScenario] = {}
-scenario_test_results: List[ScenarioTestResult] = []
+# Dict views dumped once at startup; templates and scenarios never change afterwards
+rule_template_dicts: Dict[str, Dict[str, Any]] = {}
+exploit_scenario_dicts: Dict[str, Dict[str, Any]] = {}
+# Recent scenario test results; the oldest drop off once full
+MAX_SCENARIO_RESULTS = int(os.getenv("MAX_SCENARIO_RESULTS", "10000"))
+scenario_test_results: deque = deque(maxlen=MAX_SCENARIO_RESULTS)
 
 # Utility functions
-def validate_cidr(cidr: str) -> bool:
+@functools.lru_cache(maxsize=1024)
+def parse_cidr(cidr: str) -> Optional[Tuple[int, int, int]]:
+    """Parse a CIDR block into (version, first address, last address), or None if invalid.
+
+    The same blocks recur across templates and users, and each one is both
+    validated and indexed when a rule set is created, so parsing is cached.
+    """
     try:
-        ipaddress.ip_network(cidr, strict=False)
-        return True
+        network = ipaddress.ip_network(cidr, strict=False)
     except ValueError:
-        return False
+        return None
+    return network.version, int(network.network_address), int(network.broadcast_address)
 
-def validate_ip_against_cidrs(ip: str, cidrs: List[str]) -> bool:
-    try:
-        client_ip = ipaddress.ip_address(ip)
+def validate_cidr(cidr: str) -> bool:
+    return parse_cidr(cidr) is not None
+
+class CIDRIndex:
+    """CIDR blocks stored as merged, sorted integer ranges per IP version.
+
+    Membership is a binary search over the range starts, so lookups stay
+    O(log n) however many blocks a rule set lists.
+    """
+
+    def __init__(self, cidrs: List[str]):
+        spans: Dict[int, List[Tuple[int, int]]] = {4: [], 6: []}
         for cidr in cidrs:
-            if client_ip in ipaddress.ip_network(cidr, strict=False):
-                return True
-        return False
+            version, start, end = parse_cidr(cidr)
+            spans[version].append((start, end))
+
+        self.starts: Dict[int, List[int]] = {}
+        self.ends: Dict[int, List[int]] = {}
+        for version, ranges in spans.items():
+            starts, ends = [], []
+            for start, end in sorted(ranges):
+                # Merge overlapping and adjacent blocks
+                if ends and start <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self.starts[version] = starts
+            self.ends[version] = ends
+
+    def contains(self, version: int, value: int) -> bool:
+        """Check an address given as its IP version and integer value"""
+        i = bisect.bisect_right(self.starts[version], value) - 1
+        return i >= 0 and value <= self.ends[version][i]
+
+@functools.lru_cache(maxsize=4096)
+def parse_client_ip(ip: str) -> Optional[Tuple[int, int]]:
+    """Parse a client IP into (version, integer value), or None if malformed.
+
+    Simulations replay the same few client IPs, so parsing is cached.
+    """
+    try:
+        address = ipaddress.ip_address(ip)
     except ValueError:
+        return None
+    return address.version, int(address)
+
+def validate_ip_against_cidrs(ip: str, index: CIDRIndex) -> bool:
+    parsed = parse_client_ip(ip)
+    if parsed is None:
         return False
+    return index.contains(*parsed)
 
-def validate_jwt_token(token: str, jwt_rule: JWTRule) -> tuple[bool, str]:
-    try:
+def unindex_rule_set(user_id: Optional[str], rule_set_id: str) -> None:
+    """Remove a rule set from its owner's index, dropping the owner once they have none left"""
+    user_rule_set_ids = user_rule_index.get(user_id)
+    if user_rule_set_ids is not None:
+        user_rule_set_ids.pop(rule_set_id, None)
+        if not user_rule_set_ids:
+            del user_rule_index[user_id]
+
+def store_rule_set(rule_set: FirewallRuleSet, user_id: str) -> Dict[str, Any]:
+    """Store a validated rule set for a user and precompute its lookup structures"""
+    previous = rule_sets.get(rule_set.id)
+    if previous and previous.get('userId') != user_id:
+        # Re-created under a different user: drop it from the old owner's index
+        unindex_rule_set(previous.get('userId'), rule_set.id)
+    
+    rule_set.userId = user_id
+    rule_set_dict = rule_set.model_dump()
+    rule_sets[rule_set.id] = rule_set_dict
+    user_rule_index.setdefault(user_id, {})[rule_set.id] = None
+    rule_set_models[rule_set.id] = rule_set
+    cidr_indexes[rule_set.id] = CIDRIndex(rule_set.ip_rules.cidrs if rule_set.ip_rules else [])
+    combined_path_regexes[rule_set.id] = combine_patterns(
+        [path_rule.path_pattern for path_rule in rule_set.path_rules if path_rule.condition == "regex"]
+    )
+    return rule_set_dict
+
+def remove_rule_set(rule_set_id: str) -> None:
+    """Delete a stored rule set along with its per-user index entry and lookup structures"""
+    rule_set_dict = rule_sets.pop(rule_set_id)
+    unindex_rule_set(rule_set_dict.get('userId'), rule_set_id)
+    rule_set_models.pop(rule_set_id, None)
+    cidr_indexes.pop(rule_set_id, None)
+    combined_path_regexes.pop(rule_set_id, None)
+
+class ClaimsCache:
+    """Bounded LRU of decoded JWT claims, keyed by a SHA-256 digest of the token.
+
+    Keys are fixed 32-byte digests, so cached entries do not keep large
+    tokens (or PEM keys) alive. Callers must not mutate the cached claims.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.entries: "OrderedDict[bytes, Dict[str, Any]]" = OrderedDict()
+
+    @staticmethod
+    def key(*parts: str) -> bytes:
+        return hashlib.sha256("\0".join(parts).encode()).digest()
+
+    def get(self, key: bytes) -> Optional[Dict[str, Any]]:
+        claims = self.entries.get(key)
+        if claims is not None:
+            self.entries.move_to_end(key)
+        return claims
+
+    def put(self, key: bytes, claims: Dict[str, Any]) -> None:
+        self.entries[key] = claims
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+# Claims of tokens already decoded, so replayed tokens skip base64 + JSON parsing
+decoded_jwt_cache = ClaimsCache(maxsize=10_000)
+# Claims of tokens whose signature already verified, so repeats skip the thread hop
+verified_jwt_cache = ClaimsCache(maxsize=10_000)
+
+def decode_jwt_claims(token: str) -> Dict[str, Any]:
+    """Decode JWT claims once per distinct token"""
+    cache_key = ClaimsCache.key(token)
+    decoded = decoded_jwt_cache.get(cache_key)
+    if decoded is None:
         # For simulation, we'll use a simple validation
         # In production, you'd verify with proper keys
         decoded = jwt.decode(token, options={"verify_signature": False})
+        decoded_jwt_cache.put(cache_key, decoded)
+    return decoded
+
+def verify_jwt_claims(token: str, key: str, algorithms: Tuple[str, ...]) -> Dict[str, Any]:
+    # Issuer, audience and expiry are checked by validate_jwt_token for both
+    # verified and unverified tokens, so their messages stay the same
+    return jwt.decode(
+        token,
+        load_jwt_key(key),
+        algorithms=list(algorithms),
+        options={"verify_exp": False, "verify_aud": False}
+    )
+
+async def verify_jwt_claims_async(token: str, key: str, algorithms: Tuple[str, ...]) -> Dict[str, Any]:
+    """Verify a token's signature off the event loop, caching successful results"""
+    cache_key = ClaimsCache.key(token, key, *algorithms)
+    decoded = verified_jwt_cache.get(cache_key)
+    if decoded is None:
+        # Signature checks are CPU-bound crypto, so keep them off the event loop
+        decoded = await asyncio.to_thread(verify_jwt_claims, token, key, algorithms)
+        verified_jwt_cache.put(cache_key, decoded)
+    return decoded
+
+# Sentinel for claims absent from a token (a claim may legitimately be null)
+MISSING_CLAIM = object()
+
+async def validate_jwt_token(token: str, jwt_rule: JWTRule) -> tuple[bool, str]:
+    try:
+        # Expiry is checked below on every call, so cached claims never outlive the token
+        if jwt_rule.verification_key:
+            decoded = await verify_jwt_claims_async(token, jwt_rule.verification_key, tuple(jwt_rule.algorithms))
+        else:
+            decoded = decode_jwt_claims(token)
         
         # Check issuer
         if jwt_rule.issuer and decoded.get('iss') != jwt_rule.issuer:
@@ -198,46 +501,148 @@ def validate_jwt_token(token: str, jwt_rule: JWTRule) -> tuple[bool, str]:
         
         # Check required claims
         if jwt_rule.required_claims:
+            # One lookup per claim covers both the presence and the value check
+            get_claim = decoded.get
             for claim, expected_value in jwt_rule.required_claims.items():
-                if claim not in decoded:
+                value = get_claim(claim, MISSING_CLAIM)
+                if value is MISSING_CLAIM:
                     return False, f"Missing required claim: {claim}"
-                if decoded[claim] != expected_value:
+                if value != expected_value:
                     return False, f"Invalid claim value for {claim}"
         
         # Check expiration
         if 'exp' in decoded:
-            if datetime.utcnow().timestamp() > decoded['exp']:
+            if time.time() > decoded['exp']:
                 return False, "Token expired"
         
         return True, "JWT validation passed"
     
-    except jwt.InvalidTokenError as e:
+    except (jwt.PyJWTError, ValueError, TypeError) as e:
+        # Key or algorithm problems block the request rather than failing it
         return False, f"Invalid JWT token: {str(e)}"
 
+class TokenBucket:
+    """Rate limit state for one client: remaining tokens, time of the last request,
+    and the time by which the bucket will have refilled completely"""
+    __slots__ = ("tokens", "last", "expires")
+
+    def __init__(self, tokens: float, last: float):
+        self.tokens = tokens
+        self.last = last
+        self.expires = last
+
 def check_rate_limit(client_ip: str, rule_set_id: str, rate_rule: RateLimitRule) -> tuple[bool, str]:
+    # Token bucket: holds up to requests_per_window tokens and refills
+    # continuously at requests_per_window / window_seconds tokens per second
     current_time = time.time()
     key = f"{rule_set_id}:{client_ip}"
+    capacity = rate_rule.requests_per_window
     
-    if key not in rate_limit_store:
-        rate_limit_store[key] = {
-            'requests': [],
-            'window_start': current_time
-        }
-    
-    client_data = rate_limit_store[key]
+    bucket = rate_limit_store.get(key)
+    if bucket is None:
+        bucket = rate_limit_store[key] = TokenBucket(float(capacity), current_time)
     
-    # Clean old requests outside the window
-    window_start = current_time - rate_rule.window_seconds
-    client_data['requests'] = [req_time for req_time in client_data['requests'] if req_time > window_start]
+    # Refill tokens for the time elapsed since the last request
+    elapsed = current_time - bucket.last
+    tokens = min(capacity, bucket.tokens + elapsed * capacity / rate_rule.window_seconds)
+    bucket.last = current_time
+    # After a full window without requests the bucket is indistinguishable from a new one
+    bucket.expires = current_time + rate_rule.window_seconds
     
     # Check if limit exceeded
-    if len(client_data['requests']) >= rate_rule.requests_per_window:
+    if tokens < 1:
+        bucket.tokens = tokens
         return False, f"Rate limit exceeded: {rate_rule.requests_per_window} requests per {rate_rule.window_seconds} seconds"
     
-    # Add current request
-    client_data['requests'].append(current_time)
+    # Consume a token for the current request
+    bucket.tokens = tokens - 1
+    
+    return True, f"Rate limit check passed: {round(capacity - bucket.tokens)}/{rate_rule.requests_per_window}"
+
+# How often idle in-memory rate limit buckets are dropped
+RATE_LIMIT_SWEEP_SECONDS = 60
+
+def evict_idle_rate_limits(now: float) -> int:
+    """Drop buckets that have refilled completely; returns how many were removed"""
+    idle_keys = [key for key, bucket in rate_limit_store.items() if bucket.expires <= now]
+    for key in idle_keys:
+        del rate_limit_store[key]
+    return len(idle_keys)
+
+async def sweep_rate_limits() -> None:
+    while True:
+        await asyncio.sleep(RATE_LIMIT_SWEEP_SECONDS)
+        evicted = evict_idle_rate_limits(time.time())
+        if evicted:
+            logger.info(f"🧹 Evicted {evicted} idle rate limit buckets")
+
+def combine_patterns(patterns: List[str]) -> Optional[re.Pattern]:
+    """Combine patterns into one regex that matches only if every pattern is found.
+
+    Each pattern becomes a lookahead anchored at the start of the input, so a
+    single match() call replaces one search() per pattern. Returns None when
+    there is nothing to gain or the patterns cannot be combined safely: invalid
+    syntax, inline global flags, or capture groups whose numbering (and so any
+    backreferences) would shift.
+    """
+    if len(patterns) < 2:
+        return None
+    try:
+        if any(compile_pattern(pattern).groups for pattern in patterns):
+            return None
+        return re.compile("".join(f"(?=[\\s\\S]*?(?:{pattern}))" for pattern in patterns))
+    except re.error:
+        return None
+
+# Same token bucket as check_rate_limit, run atomically inside Redis.
+# Idle buckets expire after one window, by which point they would be full again.
+RATE_LIMIT_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'last')
+local tokens = tonumber(bucket[1]) or capacity
+local last = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - last) * capacity / window)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'last', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(window))
+return {allowed, tostring(tokens)}
+"""
+rate_limit_script = redis_client.register_script(RATE_LIMIT_SCRIPT) if redis_client else None
+
+async def check_rate_limit_redis(client_ip: str, rule_set_id: str, rate_rule: RateLimitRule) -> tuple[bool, str]:
+    allowed, tokens = await rate_limit_script(
+        keys=[f"rate_limit:{rule_set_id}:{client_ip}"],
+        args=[rate_rule.requests_per_window, rate_rule.window_seconds, time.time()]
+    )
+    
+    if not allowed:
+        return False, f"Rate limit exceeded: {rate_rule.requests_per_window} requests per {rate_rule.window_seconds} seconds"
     
-    return True, f"Rate limit check passed: {len(client_data['requests'])}/{rate_rule.requests_per_window}"
+    return True, f"Rate limit check passed: {round(rate_rule.requests_per_window - float(tokens))}/{rate_rule.requests_per_window}"
+
+async def enforce_rate_limit(client_ip: str, rule_set_id: str, rate_rule: RateLimitRule) -> tuple[bool, str]:
+    """Rate limit through Redis when configured, falling back to the in-memory store"""
+    global redis_retry_at
+    if rate_limit_script and time.time() >= redis_retry_at:
+        try:
+            allowed, reason = await check_rate_limit_redis(client_ip, rule_set_id, rate_rule)
+        except redis.RedisError as e:
+            # Warn once per outage, then skip Redis until the retry time
+            if not redis_retry_at:
+                logger.warning(f"⚠️ Redis rate limiting unavailable, using in-memory store for {REDIS_RETRY_SECONDS:g}s: {str(e)}")
+            redis_retry_at = time.time() + REDIS_RETRY_SECONDS
+        else:
+            if redis_retry_at:
+                logger.info("✅ Redis rate limiting available again")
+                redis_retry_at = 0.0
+            return allowed, reason
+    return check_rate_limit(client_ip, rule_set_id, rate_rule)
 
 def validate_header_rule(headers: Dict[str, str], header_rule: HeaderRule) -> tuple[bool, str]:
     header_value = headers.get(header_rule.header_name)
@@ -261,16 +666,14 @@ def validate_header_rule(headers: Dict[str, str], header_rule: HeaderRule) -> tu
         return False, f"Header {header_rule.header_name} does not contain {header_rule.value}"
     
     elif header_rule.condition == "regex":
-        try:
-            if header_rule.value and re.search(header_rule.value, header_value):
-                return True, f"Header {header_rule.header_name} matches regex {header_rule.value}"
-            return False, f"Header {header_rule.header_name} does not match regex {header_rule.value}"
-        except re.error:
-            return False, f"Invalid regex pattern: {header_rule.value}"
+        if header_rule._compiled and header_rule._compiled.search(header_value):
+            return True, f"Header {header_rule.header_name} matches regex {header_rule.value}"
+        return False, f"Header {header_rule.header_name} does not match regex {header_rule.value}"
 
-def validate_path_rule(method: str, path: str, path_rule: PathRule) -> tuple[bool, str]:
+def validate_path_rule(method: str, path: str, path_rule: PathRule, regex_matched: Optional[bool] = None) -> tuple[bool, str]:
+    """Check one path rule; regex_matched short-circuits a regex rule already known to match"""
     # Check method
-    if path_rule.methods and method.upper() not in [m.upper() for m in path_rule.methods]:
+    if path_rule.methods and method.upper() not in path_rule._allowed_methods:
         return False, f"Method {method} not in allowed methods: {path_rule.methods}"
     
     # Check path
@@ -285,12 +688,72 @@ def validate_path_rule(method: str, path: str, path_rule: PathRule) -> tuple[boo
         return False, f"Path {path} does not start with {path_rule.path_pattern}"
     
     elif path_rule.condition == "regex":
-        try:
-            if re.search(path_rule.path_pattern, path):
-                return True, f"Path {path} matches regex {path_rule.path_pattern}"
-            return False, f"Path {path} does not match regex {path_rule.path_pattern}"
-        except re.error:
-            return False, f"Invalid regex pattern: {path_rule.path_pattern}"
+        if regex_matched or path_rule._compiled.search(path):
+            return True, f"Path {path} matches regex {path_rule.path_pattern}"
+        return False, f"Path {path} does not match regex {path_rule.path_pattern}"
+
+# Simulation checks. Each produces (passed, reason) pairs and stops being
+# consumed at the first failure, so later rules in a check are skipped.
+# Stateless checks are plain generators; only the JWT and rate limit checks,
+# which may await I/O, are coroutines returning their results as a list.
+def check_ip_rules(simulation: SimulationRequest, rule_set: FirewallRuleSet) -> Iterator[Tuple[bool, str]]:
+    if not rule_set.ip_rules:
+        return
+    ip_match = validate_ip_against_cidrs(simulation.client_ip, cidr_indexes[rule_set.id])
+    if rule_set.ip_rules.type == "block" and ip_match:
+        yield False, f"IP {simulation.client_ip} is in blocked CIDR list"
+    elif rule_set.ip_rules.type == "allow" and not ip_match:
+        yield False, f"IP {simulation.client_ip} is not in allowed CIDR list"
+    else:
+        yield True, f"IP rule check passed for {simulation.client_ip}"
+
+def check_path_rules(simulation: SimulationRequest, rule_set: FirewallRuleSet) -> Iterator[Tuple[bool, str]]:
+    # One combined match settles every regex rule at once when it succeeds;
+    # otherwise each regex rule is searched on its own to find the failure
+    combined_regex = combined_path_regexes.get(rule_set.id)
+    regex_matched = None
+    for path_rule in rule_set.path_rules:
+        if combined_regex and path_rule.condition == "regex" and regex_matched is None:
+            regex_matched = combined_regex.match(simulation.path) is not None
+        yield validate_path_rule(simulation.method, simulation.path, path_rule, regex_matched)
+
+def check_header_rules(simulation: SimulationRequest, rule_set: FirewallRuleSet) -> Iterator[Tuple[bool, str]]:
+    for header_rule in rule_set.header_rules:
+        yield validate_header_rule(simulation.headers, header_rule)
+
+def check_oauth2_validation(simulation: SimulationRequest, rule_set: FirewallRuleSet) -> Iterator[Tuple[bool, str]]:
+    if not (rule_set.oauth2_validation and rule_set.oauth2_validation.enabled):
+        return
+    missing_scopes = rule_set.oauth2_validation._required.difference(simulation.oauth_scopes)
+    if missing_scopes:
+        yield False, f"Missing required OAuth2 scopes: {list(missing_scopes)}"
+    else:
+        yield True, f"OAuth2 scope validation passed: {list(dict.fromkeys(simulation.oauth_scopes))}"
+
+async def check_jwt_validation(simulation: SimulationRequest, rule_set: FirewallRuleSet) -> List[Tuple[bool, str]]:
+    if not (rule_set.jwt_validation and rule_set.jwt_validation.enabled):
+        return []
+    if not simulation.jwt_token:
+        return [(False, "JWT token required but not provided")]
+    return [await validate_jwt_token(simulation.jwt_token, rule_set.jwt_validation)]
+
+async def check_rate_limiting(simulation: SimulationRequest, rule_set: FirewallRuleSet) -> List[Tuple[bool, str]]:
+    if not (rule_set.rate_limiting and rule_set.rate_limiting.enabled):
+        return []
+    return [await enforce_rate_limit(simulation.client_ip, rule_set.id, rule_set.rate_limiting)]
+
+# Ordered cheapest and most selective first. Rate limiting runs right after
+# the header check and before the OAuth2 and JWT checks, so a flood is
+# rejected without decoding or verifying tokens, and attempts later blocked
+# by a token check still count against the client's quota.
+SIMULATION_CHECKS: List[Tuple[str, Callable[[SimulationRequest, FirewallRuleSet], Union[Iterable[Tuple[bool, str]], Awaitable[List[Tuple[bool, str]]]]]]] = [
+    ("ip_rules", check_ip_rules),
+    ("path_rules", check_path_rules),
+    ("header_rules", check_header_rules),
+    ("rate_limiting", check_rate_limiting),
+    ("oauth2_validation", check_oauth2_validation),
+    ("jwt_validation", check_jwt_validation),
+]
 
 # Initialize default templates and scenarios
 def initialize_default_templates():
@@ -392,6 +855,7 @@ def initialize_default_templates():
     for template_data in default_templates:
         template = RuleTemplate(**template_data)
         rule_templates[template.id] = template
+        rule_template_dicts[template.id] = template.model_dump()
 
 def initialize_default_scenarios():
     """Initialize default exploit scenarios"""
@@ -478,6 +942,7 @@ def initialize_default_scenarios():
     for scenario_data in default_scenarios:
         scenario = ExploitScenario(**scenario_data)
         exploit_scenarios[scenario.id] = scenario
+        exploit_scenario_dicts[scenario.id] = scenario.model_dump()
 
 # Initialize defaults on startup
 initialize_default_templates()
@@ -495,18 +960,14 @@ async def create_rule_set(rule_set: FirewallRuleSet, x_user_id: Optional[str] =
         user_id = get_user_id(x_user_id)
         logger.info(f"🔒 Creating/updating rule set '{rule_set.id}' for user: {user_id}")
         
-        # Add user ID to the rule set
-        rule_set_dict = rule_set.dict()
-        rule_set_dict = add_user_id_to_item(rule_set_dict, user_id)
-        
         # Validate CIDR blocks if IP rules exist
         if rule_set.ip_rules:
             for cidr in rule_set.ip_rules.cidrs:
                 if not validate_cidr(cidr):
                     raise HTTPException(status_code=400, detail=f"Invalid CIDR format: {cidr}")
         
-        # Store the rule set
-        rule_sets[rule_set.id] = rule_set_dict
+        # Store the rule set with the user ID attached
+        store_rule_set(rule_set, user_id)
         
         logger.info(f"✅ Rule set '{rule_set.id}' stored successfully for user: {user_id}")
         return {"status": "success", "rule_set_id": rule_set.id}
@@ -515,42 +976,36 @@ async def create_rule_set(rule_set: FirewallRuleSet, x_user_id: Optional[str] =
         logger.error(f"❌ Error creating rule set: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/rules", response_model=List[Dict[str, Any]])
+@app.get("/rules")
 async def get_rule_sets(x_user_id: Optional[str] = Header(None)):
     """Get all rule sets for the current user"""
     try:
         user_id = get_user_id(x_user_id)
-        logger.info(f"🔒 Fetching rule sets for user: {user_id}")
         
-        # Convert to list and filter by user
-        all_rule_sets = list(rule_sets.values())
-        user_rule_sets = filter_by_user(all_rule_sets, user_id)
+        # Look up only this user's rule sets through the per-user index
+        user_rule_sets = [rule_sets[rule_set_id] for rule_set_id in user_rule_index.get(user_id, ())]
         
-        logger.info(f"📊 Returning {len(user_rule_sets)} rule sets for user: {user_id} (out of {len(all_rule_sets)} total)")
-        return user_rule_sets
+        logger.info(f"📊 Returning {len(user_rule_sets)} rule sets for user: {user_id} (out of {len(rule_sets)} total)")
+        return ORJSONResponse(user_rule_sets)
     
     except Exception as e:
         logger.error(f"❌ Error fetching rule sets: {str(e)}")
         return []
 
-@app.get("/rules/{rule_set_id}", response_model=Dict[str, Any])
+@app.get("/rules/{rule_set_id}")
 async def get_rule_set(rule_set_id: str, x_user_id: Optional[str] = Header(None)):
     """Get a specific rule set if it belongs to the current user"""
     try:
         user_id = get_user_id(x_user_id)
         logger.info(f"🔒 Fetching rule set '{rule_set_id}' for user: {user_id}")
         
-        if rule_set_id not in rule_sets:
-            raise HTTPException(status_code=404, detail="Rule set not found")
-        
-        rule_set = rule_sets[rule_set_id]
-        
         # Check if the rule set belongs to the current user
-        if rule_set.get('userId') != user_id:
-            logger.warning(f"🚫 Access denied: Rule set '{rule_set_id}' belongs to different user")
+        if rule_set_id not in user_rule_index.get(user_id, ()):
+            if rule_set_id in rule_sets:
+                logger.warning(f"🚫 Access denied: Rule set '{rule_set_id}' belongs to different user")
             raise HTTPException(status_code=404, detail="Rule set not found")
         
-        return rule_set
+        return ORJSONResponse(rule_sets[rule_set_id])
     
     except HTTPException:
         raise
@@ -565,18 +1020,14 @@ async def delete_rule_set(rule_set_id: str, x_user_id: Optional[str] = Header(No
         user_id = get_user_id(x_user_id)
         logger.info(f"🔒 Deleting rule set '{rule_set_id}' for user: {user_id}")
         
-        if rule_set_id not in rule_sets:
-            raise HTTPException(status_code=404, detail="Rule set not found")
-        
-        rule_set = rule_sets[rule_set_id]
-        
         # Check if the rule set belongs to the current user
-        if rule_set.get('userId') != user_id:
-            logger.warning(f"🚫 Access denied: Cannot delete rule set '{rule_set_id}' - belongs to different user")
+        if rule_set_id not in user_rule_index.get(user_id, ()):
+            if rule_set_id in rule_sets:
+                logger.warning(f"🚫 Access denied: Cannot delete rule set '{rule_set_id}' - belongs to different user")
             raise HTTPException(status_code=404, detail="Rule set not found")
         
         # Delete the rule set
-        del rule_sets[rule_set_id]
+        remove_rule_set(rule_set_id)
         
         logger.info(f"✅ Rule set '{rule_set_id}' deleted successfully for user: {user_id}")
         return {"status": "success", "message": f"Rule set {rule_set_id} deleted"}
@@ -587,7 +1038,102 @@ async def delete_rule_set(rule_set_id: str, x_user_id: Optional[str] = Header(No
         logger.error(f"❌ Error deleting rule set: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/simulate", response_model=SimulationResult)
+def get_user_rule_set(rule_set_id: str, user_id: str) -> FirewallRuleSet:
+    """Return a stored rule set model, or 404 if it is missing or owned by another user"""
+    # Ownership is a membership test on the user's own index entry
+    if rule_set_id not in user_rule_index.get(user_id, ()):
+        if rule_set_id in rule_sets:
+            logger.warning(f"🚫 Access denied: Rule set '{rule_set_id}' belongs to different user")
+        raise HTTPException(status_code=404, detail="Rule set not found")
+    
+    return rule_set_models[rule_set_id]
+
+def log_evaluation(simulation: SimulationRequest, result: SimulationResult) -> Dict[str, Any]:
+    """Append a simulation result to the evaluation log and return it as a dict"""
+    result_data = result.model_dump()
+    # Serialized once up front; the timestamp is formatted only when logs are read
+    log_entry = orjson.dumps({
+        "rule_set_id": simulation.rule_set_id,
+        "client_ip": simulation.client_ip,
+        "result": result_data,
+        "userId": result.userId
+    })
+    user_logs = evaluation_logs.get(result.userId)
+    if user_logs is None:
+        user_logs = evaluation_logs[result.userId] = deque(maxlen=MAX_EVALUATION_LOGS_PER_USER)
+    user_logs.append((time.time(), log_entry))
+    return result_data
+
+async def evaluate_simulation(simulation: SimulationRequest, rule_set: FirewallRuleSet, user_id: str) -> Dict[str, Any]:
+    """Run a simulated request through a rule set's checks, log the result and return it as a dict"""
+    evaluation_details = []
+    
+    # Run checks in order and stop at the first one that fails
+    decision = None
+    for matched_rule, check in SIMULATION_CHECKS:
+        results = check(simulation, rule_set)
+        if inspect.isawaitable(results):
+            results = await results
+        for passed, reason in results:
+            if not passed:
+                decision = "BLOCKED"
+                break
+            evaluation_details.append(reason)
+        if decision:
+            logger.info(f"🚫 Request blocked by {matched_rule} for user: {user_id}")
+            break
+    else:
+        # If all checks pass, apply default action
+        decision = "ALLOWED" if rule_set.default_action == "allow" else "BLOCKED"
+        matched_rule = "default_action"
+        reason = f"All rules passed, applying default action: {rule_set.default_action}"
+        logger.info(f"✅ Simulation completed for user: {user_id}, decision: {decision}")
+    
+    return log_evaluation(simulation, SimulationResult(
+        decision=decision,
+        matched_rule=matched_rule,
+        reason=reason,
+        evaluation_details=evaluation_details,
+        userId=user_id
+    ))
+
+async def evaluate_scenario_request(rule_set: FirewallRuleSet, client_ip: str, jwt_token: Optional[str]) -> Tuple[str, str, str]:
+    """Run a scenario test request through the IP and JWT checks, returning (decision, matched_rule, reason)"""
+    # Simulate the request manually here instead of calling the endpoint
+    # to avoid circular dependencies
+    decision = "ALLOWED"  # Default
+    matched_rule = "default_action"
+    reason = "Default action applied"
+    
+    # Basic simulation logic (simplified version)
+    if rule_set.ip_rules and rule_set.ip_rules.type == "block":
+        if validate_ip_against_cidrs(client_ip, cidr_indexes[rule_set.id]):
+            decision = "BLOCKED"
+            matched_rule = "ip_rules"
+            reason = "IP blocked by IP rules"
+    
+    # Add JWT validation check
+    if rule_set.jwt_validation and rule_set.jwt_validation.enabled:
+        if not jwt_token:
+            decision = "BLOCKED"
+            matched_rule = "jwt_validation"
+            reason = "JWT token required but not provided"
+        else:
+            jwt_valid, jwt_reason = await validate_jwt_token(jwt_token, rule_set.jwt_validation)
+            if not jwt_valid:
+                decision = "BLOCKED"
+                matched_rule = "jwt_validation"
+                reason = jwt_reason
+    
+    # Apply default action if no blocking rules matched
+    if decision == "ALLOWED" and rule_set.default_action == "block":
+        decision = "BLOCKED"
+    
+    return decision, matched_rule, reason
+
+# Results are built from validated models, so skip response_model re-validation
+# and only document the schema
+@app.post("/simulate", responses={200: {"model": SimulationResult}})
 async def simulate_request(simulation: SimulationRequest, x_user_id: Optional[str] = Header(None)):
     """Simulate an API request against firewall rules with user isolation"""
     try:
@@ -598,222 +1144,9 @@ async def simulate_request(simulation: SimulationRequest, x_user_id: Optional[st
         if not simulation.userId:
             simulation.userId = user_id
         
-        if simulation.rule_set_id not in rule_sets:
-            raise HTTPException(status_code=404, detail="Rule set not found")
-        
-        rule_set_data = rule_sets[simulation.rule_set_id]
-        
-        # Check if the rule set belongs to the current user
-        if rule_set_data.get('userId') != user_id:
-            logger.warning(f"🚫 Access denied: Rule set '{simulation.rule_set_id}' belongs to different user")
-            raise HTTPException(status_code=404, detail="Rule set not found")
-        
-        rule_set = FirewallRuleSet(**rule_set_data)
-        evaluation_details = []
-        
-        # Check IP rules first
-        if rule_set.ip_rules:
-            ip_match = validate_ip_against_cidrs(simulation.client_ip, rule_set.ip_rules.cidrs)
-            if rule_set.ip_rules.type == "block" and ip_match:
-                result = SimulationResult(
-                    decision="BLOCKED",
-                    matched_rule="ip_rules",
-                    reason=f"IP {simulation.client_ip} is in blocked CIDR list",
-                    evaluation_details=evaluation_details,
-                    userId=user_id
-                )
-                # Log evaluation with user ID
-                log_entry = {
-                    "timestamp": datetime.utcnow().isoformat(),
-                    "rule_set_id": simulation.rule_set_id,
-                    "client_ip": simulation.client_ip,
-                    "result": result.dict(),
-                    "userId": user_id
-                }
-                evaluation_logs.append(log_entry)
-                logger.info(f"🚫 Request blocked by IP rules for user: {user_id}")
-                return result
-            
-            elif rule_set.ip_rules.type == "allow" and not ip_match:
-                result = SimulationResult(
-                    decision="BLOCKED",
-                    matched_rule="ip_rules",
-                    reason=f"IP {simulation.client_ip} is not in allowed CIDR list",
-                    evaluation_details=evaluation_details,
-                    userId=user_id
-                )
-                log_entry = {
-                    "timestamp": datetime.utcnow().isoformat(),
-                    "rule_set_id": simulation.rule_set_id,
-                    "client_ip": simulation.client_ip,
-                    "result": result.dict(),
-                    "userId": user_id
-                }
-                evaluation_logs.append(log_entry)
-                logger.info(f"🚫 Request blocked by IP rules for user: {user_id}")
-                return result
-            
-            evaluation_details.append(f"IP rule check passed for {simulation.client_ip}")
-        
-        # Check JWT validation
-        if rule_set.jwt_validation and rule_set.jwt_validation.enabled:
-            if not simulation.jwt_token:
-                result = SimulationResult(
-                    decision="BLOCKED",
-                    matched_rule="jwt_validation",
-                    reason="JWT token required but not provided",
-                    evaluation_details=evaluation_details,
-                    userId=user_id
-                )
-                log_entry = {
-                    "timestamp": datetime.utcnow().isoformat(),
-                    "rule_set_id": simulation.rule_set_id,
-                    "client_ip": simulation.client_ip,
-                    "result": result.dict(),
-                    "userId": user_id
-                }
-                evaluation_logs.append(log_entry)
-                return result
-            
-            jwt_valid, jwt_reason = validate_jwt_token(simulation.jwt_token, rule_set.jwt_validation)
-            if not jwt_valid:
-                result = SimulationResult(
-                    decision="BLOCKED",
-                    matched_rule="jwt_validation",
-                    reason=jwt_reason,
-                    evaluation_details=evaluation_details,
-                    userId=user_id
-                )
-                log_entry = {
-                    "timestamp": datetime.utcnow().isoformat(),
-                    "rule_set_id": simulation.rule_set_id,
-                    "client_ip": simulation.client_ip,
-                    "result": result.dict(),
-                    "userId": user_id
-                }
-                evaluation_logs.append(log_entry)
-                return result
-            
-            evaluation_details.append(jwt_reason)
-        
-        # Check OAuth2 validation
-        if rule_set.oauth2_validation and rule_set.oauth2_validation.enabled:
-            required_scopes = set(rule_set.oauth2_validation.required_scopes)
-            provided_scopes = set(simulation.oauth_scopes)
-            missing_scopes = required_scopes - provided_scopes
-            
-            if missing_scopes:
-                result = SimulationResult(
-                    decision="BLOCKED",
-                    matched_rule="oauth2_validation",
-                    reason=f"Missing required OAuth2 scopes: {list(missing_scopes)}",
-                    evaluation_details=evaluation_details,
-                    userId=user_id
-                )
-                log_entry = {
-                    "timestamp": datetime.utcnow().isoformat(),
-                    "rule_set_id": simulation.rule_set_id,
-                    "client_ip": simulation.client_ip,
-                    "result": result.dict(),
-                    "userId": user_id
-                }
-                evaluation_logs.append(log_entry)
-                return result
-            
-            evaluation_details.append(f"OAuth2 scope validation passed: {list(provided_scopes)}")
-        
-        # Check rate limiting
-        if rule_set.rate_limiting and rule_set.rate_limiting.enabled:
-            rate_ok, rate_reason = check_rate_limit(
-                simulation.client_ip, 
-                simulation.rule_set_id, 
-                rule_set.rate_limiting
-            )
-            if not rate_ok:
-                result = SimulationResult(
-                    decision="BLOCKED",
-                    matched_rule="rate_limiting",
-                    reason=rate_reason,
-                    evaluation_details=evaluation_details,
-                    userId=user_id
-                )
-                log_entry = {
-                    "timestamp": datetime.utcnow().isoformat(),
-                    "rule_set_id": simulation.rule_set_id,
-                    "client_ip": simulation.client_ip,
-                    "result": result.dict(),
-                    "userId": user_id
-                }
-                evaluation_logs.append(log_entry)
-                return result
-            
-            evaluation_details.append(rate_reason)
-        
-        # Check header rules
-        for header_rule in rule_set.header_rules:
-            header_ok, header_reason = validate_header_rule(simulation.headers, header_rule)
-            if not header_ok:
-                result = SimulationResult(
-                    decision="BLOCKED",
-                    matched_rule="header_rules",
-                    reason=header_reason,
-                    evaluation_details=evaluation_details,
-                    userId=user_id
-                )
-                log_entry = {
-                    "timestamp": datetime.utcnow().isoformat(),
-                    "rule_set_id": simulation.rule_set_id,
-                    "client_ip": simulation.client_ip,
-                    "result": result.dict(),
-                    "userId": user_id
-                }
-                evaluation_logs.append(log_entry)
-                return result
-            evaluation_details.append(header_reason)
-        
-        # Check path rules
-        for path_rule in rule_set.path_rules:
-            path_ok, path_reason = validate_path_rule(simulation.method, simulation.path, path_rule)
-            if not path_ok:
-                result = SimulationResult(
-                    decision="BLOCKED",
-                    matched_rule="path_rules",
-                    reason=path_reason,
-                    evaluation_details=evaluation_details,
-                    userId=user_id
-                )
-                log_entry = {
-                    "timestamp": datetime.utcnow().isoformat(),
-                    "rule_set_id": simulation.rule_set_id,
-                    "client_ip": simulation.client_ip,
-                    "result": result.dict(),
-                    "userId": user_id
-                }
-                evaluation_logs.append(log_entry)
-                return result
-            evaluation_details.append(path_reason)
-        
-        # If all checks pass, apply default action
-        decision = "ALLOWED" if rule_set.default_action == "allow" else "BLOCKED"
-        result = SimulationResult(
-            decision=decision,
-            matched_rule="default_action",
-            reason=f"All rules passed, applying default action: {rule_set.default_action}",
-            evaluation_details=evaluation_details,
-            userId=user_id
-        )
-        
-        log_entry = {
-            "timestamp": datetime.utcnow().isoformat(),
-            "rule_set_id": simulation.rule_set_id,
-            "client_ip": simulation.client_ip,
-            "result": result.dict(),
-            "userId": user_id
-        }
-        evaluation_logs.append(log_entry)
-        
-        logger.info(f"✅ Simulation completed for user: {user_id}, decision: {decision}")
-        return result
+        rule_set = get_user_rule_set(simulation.rule_set_id, user_id)
+        # Return ORJSONResponse directly so FastAPI skips jsonable_encoder
+        return ORJSONResponse(await evaluate_simulation(simulation, rule_set, user_id))
     
     except HTTPException:
         raise
@@ -821,19 +1154,57 @@ async def simulate_request(simulation: SimulationRequest, x_user_id: Optional[st
         logger.error(f"❌ Error during simulation for user {get_user_id(x_user_id)}: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/logs", response_model=List[Dict[str, Any]])
+@app.post("/simulate/batch", responses={200: {"model": List[SimulationResult]}})
+async def simulate_batch(simulations: Annotated[List[SimulationRequest], Body(max_length=MAX_BATCH_SIMULATIONS)], x_user_id: Optional[str] = Header(None)):
+    """Simulate several API requests in one call, in order, with user isolation"""
+    try:
+        user_id = get_user_id(x_user_id)
+        logger.info(f"🔒 Simulating batch of {len(simulations)} requests for user: {user_id}")
+        
+        # Resolve every rule set up front so an unknown one fails the whole batch
+        # before any request is evaluated or counted against a rate limit
+        batch_rule_sets = {}
+        for simulation in simulations:
+            if simulation.rule_set_id not in batch_rule_sets:
+                batch_rule_sets[simulation.rule_set_id] = get_user_rule_set(simulation.rule_set_id, user_id)
+        
+        results = []
+        for simulation in simulations:
+            if not simulation.userId:
+                simulation.userId = user_id
+            results.append(await evaluate_simulation(simulation, batch_rule_sets[simulation.rule_set_id], user_id))
+        
+        return ORJSONResponse(results)
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Error during batch simulation for user {get_user_id(x_user_id)}: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/logs")
 async def get_evaluation_logs(limit: int = 100, x_user_id: Optional[str] = Header(None)):
     """Get evaluation logs for the current user only"""
     try:
         user_id = get_user_id(x_user_id)
-        logger.info(f"🔒 Fetching evaluation logs for user: {user_id}")
-        
-        # Filter logs by user and apply limit
-        user_logs = filter_by_user(evaluation_logs, user_id)
-        limited_logs = user_logs[-limit:] if user_logs else []
         
-        logger.info(f"📊 Returning {len(limited_logs)} logs for user: {user_id} (out of {len(evaluation_logs)} total)")
-        return limited_logs
+        # Take the user's most recent logs, up to the limit
+        user_logs = evaluation_logs.get(user_id, ())
+        if limit > 0:
+            # Walk back from the newest entry and stop once the limit is reached
+            limited_logs = list(itertools.islice(reversed(user_logs), limit))
+            limited_logs.reverse()
+        else:
+            limited_logs = list(user_logs)[-limit:]
+        
+        logger.info(f"📊 Returning {len(limited_logs)} logs for user: {user_id} (out of {len(user_logs)} for this user)")
+        # Entries are already JSON, so splice in the timestamp and join them
+        # into the array without re-encoding
+        body = b",".join(
+            b'{"timestamp":"' + format_timestamp(timestamp).encode() + b'",' + log_entry[1:]
+            for timestamp, log_entry in limited_logs
+        )
+        return Response(content=b"[" + body + b"]", media_type="application/json")
     
     except Exception as e:
         logger.error(f"❌ Error fetching logs: {str(e)}")
@@ -846,10 +1217,8 @@ async def clear_evaluation_logs(x_user_id: Optional[str] = Header(None)):
         user_id = get_user_id(x_user_id)
         logger.info(f"🔒 Clearing evaluation logs for user: {user_id}")
         
-        global evaluation_logs
-        # Remove only the current user's logs
-        user_logs_count = len(filter_by_user(evaluation_logs, user_id))
-        evaluation_logs = [log for log in evaluation_logs if log.get('userId') != user_id]
+        # Other users' logs live in their own buffers and are left untouched
+        user_logs_count = len(evaluation_logs.pop(user_id, ()))
         
         logger.info(f"🧹 Cleared {user_logs_count} logs for user: {user_id}")
         return {"message": f"Cleared {user_logs_count} evaluation logs"}
@@ -859,31 +1228,30 @@ async def clear_evaluation_logs(x_user_id: Optional[str] = Header(None)):
         raise HTTPException(status_code=500, detail=str(e))
 
 # Template Management Endpoints
-@app.get("/templates", response_model=List[Dict[str, Any]])
+@app.get("/templates")
 async def get_rule_templates(category: Optional[str] = None, x_user_id: Optional[str] = Header(None)):
     """Get all available rule templates, filtered by category if specified"""
     try:
         user_id = get_user_id(x_user_id)
-        logger.info(f"🔒 Fetching templates for user: {user_id}, category: {category}")
         
         # Get public templates and user's private templates
         available_templates = []
-        for template in rule_templates.values():
+        for template_id, template in rule_templates.items():
             if template.is_public or template.userId == user_id:
-                available_templates.append(template.dict())
+                available_templates.append(rule_template_dicts[template_id])
         
         # Filter by category if specified
         if category:
             available_templates = [t for t in available_templates if t['category'] == category]
         
-        logger.info(f"📊 Returning {len(available_templates)} templates for user: {user_id}")
+        logger.info(f"📊 Returning {len(available_templates)} templates for user: {user_id}, category: {category}")
         return available_templates
     
     except Exception as e:
         logger.error(f"❌ Error fetching templates: {str(e)}")
         return []
 
-@app.get("/templates/{template_id}", response_model=Dict[str, Any])
+@app.get("/templates/{template_id}")
 async def get_rule_template(template_id: str, x_user_id: Optional[str] = Header(None)):
     """Get a specific rule template"""
     try:
@@ -898,7 +1266,7 @@ async def get_rule_template(template_id: str, x_user_id: Optional[str] = Header(
         if not template.is_public and template.userId != user_id:
             raise HTTPException(status_code=403, detail="Access denied to this template")
         
-        return template.dict()
+        return rule_template_dicts[template_id]
     
     except HTTPException:
         raise
@@ -933,7 +1301,7 @@ async def apply_rule_template(template_id: str, rule_set_name: str, x_user_id: O
         
         # Convert to FirewallRuleSet model and validate
         rule_set = FirewallRuleSet(**rule_config)
-        rule_sets[rule_set_id] = add_user_id_to_item(rule_set.dict(), user_id)
+        store_rule_set(rule_set, user_id)
         
         logger.info(f"✅ Template {template_id} applied successfully for user: {user_id}")
         return {"message": f"Template applied successfully", "rule_set_id": rule_set_id}
@@ -945,31 +1313,30 @@ async def apply_rule_template(template_id: str, rule_set_name: str, x_user_id: O
         raise HTTPException(status_code=500, detail=str(e))
 
 # Exploit Scenario Endpoints
-@app.get("/scenarios", response_model=List[Dict[str, Any]])
+@app.get("/scenarios")
 async def get_exploit_scenarios(category: Optional[str] = None, x_user_id: Optional[str] = Header(None)):
     """Get all available exploit scenarios, filtered by category if specified"""
     try:
         user_id = get_user_id(x_user_id)
-        logger.info(f"🔒 Fetching scenarios for user: {user_id}, category: {category}")
         
         # Get public scenarios and user's private scenarios
         available_scenarios = []
-        for scenario in exploit_scenarios.values():
+        for scenario_id, scenario in exploit_scenarios.items():
             if scenario.is_public or scenario.userId == user_id:
-                available_scenarios.append(scenario.dict())
+                available_scenarios.append(exploit_scenario_dicts[scenario_id])
         
         # Filter by category if specified
         if category:
             available_scenarios = [s for s in available_scenarios if s['category'] == category]
         
-        logger.info(f"📊 Returning {len(available_scenarios)} scenarios for user: {user_id}")
+        logger.info(f"📊 Returning {len(available_scenarios)} scenarios for user: {user_id}, category: {category}")
         return available_scenarios
     
     except Exception as e:
         logger.error(f"❌ Error fetching scenarios: {str(e)}")
         return []
 
-@app.get("/scenarios/{scenario_id}", response_model=Dict[str, Any])
+@app.get("/scenarios/{scenario_id}")
 async def get_exploit_scenario(scenario_id: str, x_user_id: Optional[str] = Header(None)):
     """Get a specific exploit scenario"""
     try:
@@ -984,7 +1351,7 @@ async def get_exploit_scenario(scenario_id: str, x_user_id: Optional[str] = Head
         if not scenario.is_public and scenario.userId != user_id:
             raise HTTPException(status_code=403, detail="Access denied to this scenario")
         
-        return scenario.dict()
+        return exploit_scenario_dicts[scenario_id]
     
     except HTTPException:
         raise
@@ -1000,7 +1367,7 @@ async def test_exploit_scenario(scenario_id: str, rule_set_id: str, x_user_id: O
         logger.info(f"🔒 Testing scenario {scenario_id} against rule set {rule_set_id} for user: {user_id}")
         
         # Debug: Log all available rule sets for this user
-        user_rule_sets = [rs_id for rs_id, rs_data in rule_sets.items() if rs_data.get('userId') == user_id]
+        user_rule_sets = list(user_rule_index.get(user_id, ()))
         logger.info(f"📊 Available rule sets for user {user_id}: {user_rule_sets}")
         
         # Validate scenario exists and access
@@ -1012,70 +1379,28 @@ async def test_exploit_scenario(scenario_id: str, rule_set_id: str, x_user_id: O
             raise HTTPException(status_code=403, detail="Access denied to this scenario")
         
         # Validate rule set exists and belongs to user
-        if rule_set_id not in rule_sets:
-            logger.error(f"❌ Rule set {rule_set_id} not found in rule_sets. Available: {list(rule_sets.keys())}")
-            raise HTTPException(status_code=404, detail="Rule set not found")
-        
-        stored_rule_set = rule_sets[rule_set_id]
-        if stored_rule_set.get('userId') != user_id:
-            logger.error(f"❌ Rule set {rule_set_id} belongs to user {stored_rule_set.get('userId')}, not {user_id}")
-            raise HTTPException(status_code=404, detail="Rule set not found")
-        
-        # Convert stored rule set back to model
-        rule_set = FirewallRuleSet(**stored_rule_set)
+        rule_set = get_user_rule_set(rule_set_id, user_id)
         
         # Run the test scenario
         test_details = []
         passed_tests = 0
         total_tests = len(scenario.test_requests)
+        # The outcome depends only on the client IP and JWT, and test requests
+        # often repeat them, so evaluate each distinct pair once
+        outcomes: Dict[Tuple[str, Optional[str]], Tuple[str, str, str]] = {}
         
         for i, test_request in enumerate(scenario.test_requests):
             expected_result = scenario.expected_results[i] if i < len(scenario.expected_results) else "BLOCKED"
             
-            # Create simulation request
-            sim_request = SimulationRequest(
-                rule_set_id=rule_set_id,
-                client_ip=test_request.get('client_ip', '192.168.1.100'),
-                method=test_request.get('method', 'GET'),
-                path=test_request.get('path', '/'),
-                headers=test_request.get('headers', {}),
-                jwt_token=test_request.get('jwt_token'),
-                oauth_scopes=test_request.get('oauth_scopes', []),
-                userId=user_id
-            )
-            
-            # Simulate the request (reuse existing simulation logic)
-            # We need to simulate this manually here instead of calling the endpoint
-            # to avoid circular dependencies
-            
-            evaluation_details = []
-            decision = "ALLOWED"  # Default
-            matched_rule = "default_action"
-            reason = "Default action applied"
+            # Only the client IP and JWT are checked, so read them straight from
+            # the scenario's test request instead of building a SimulationRequest
+            client_ip = test_request.get('client_ip', '192.168.1.100')
+            jwt_token = test_request.get('jwt_token')
             
-            # Basic simulation logic (simplified version)
-            if rule_set.ip_rules and rule_set.ip_rules.type == "block":
-                if validate_ip_against_cidrs(sim_request.client_ip, rule_set.ip_rules.cidrs):
-                    decision = "BLOCKED"
-                    matched_rule = "ip_rules"
-                    reason = "IP blocked by IP rules"
-            
-            # Add JWT validation check
-            if rule_set.jwt_validation and rule_set.jwt_validation.enabled:
-                if not sim_request.jwt_token:
-                    decision = "BLOCKED"
-                    matched_rule = "jwt_validation"
-                    reason = "JWT token required but not provided"
-                else:
-                    jwt_valid, jwt_reason = validate_jwt_token(sim_request.jwt_token, rule_set.jwt_validation)
-                    if not jwt_valid:
-                        decision = "BLOCKED"
-                        matched_rule = "jwt_validation"
-                        reason = jwt_reason
-            
-            # Apply default action if no blocking rules matched
-            if decision == "ALLOWED" and rule_set.default_action == "block":
-                decision = "BLOCKED"
+            outcome = outcomes.get((client_ip, jwt_token))
+            if outcome is None:
+                outcome = outcomes[client_ip, jwt_token] = await evaluate_scenario_request(rule_set, client_ip, jwt_token)
+            decision, matched_rule, reason = outcome
             
             # Check if result matches expectation
             test_passed = decision == expected_result
@@ -1129,21 +1454,14 @@ async def health_check():
     try:
         # Calculate user statistics
         total_rule_sets = len(rule_sets)
-        total_logs = len(evaluation_logs)
-        
-        # Count unique users
-        unique_users = set()
-        for rule_set in rule_sets.values():
-            if rule_set.get('userId'):
-                unique_users.add(rule_set['userId'])
+        total_logs = sum(len(user_logs) for user_logs in evaluation_logs.values())
         
-        for log in evaluation_logs:
-            if log.get('userId'):
-                unique_users.add(log['userId'])
+        # Users with rule sets or logs; neither index keeps empty entries
+        unique_users = user_rule_index.keys() | evaluation_logs.keys()
         
         return {
             "status": "healthy",
-            "timestamp": datetime.utcnow().isoformat(),
+            "timestamp": format_timestamp(time.time()),
             "version": "1.0.0",
             "statistics": {
                 "total_rule_sets": total_rule_sets,
@@ -1157,9 +1475,18 @@ async def health_check():
         return {
             "status": "error", 
             "error": str(e),
-            "timestamp": datetime.utcnow().isoformat()
+            "timestamp": format_timestamp(time.time())
         }
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
+    # "auto" picks uvloop and httptools when installed (uvicorn[standard])
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+        loop="auto",
+        http="auto",
+        access_log=False
+    ) 
\ No newline at end of file